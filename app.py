@@ -2,19 +2,27 @@
 
 import argparse
 import logging
+import os
 import time
 from base64 import urlsafe_b64decode
 from binascii import Error as BinasciiError
+from functools import partial
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool, AsyncResult
 from pprint import PrettyPrinter
 from typing import Optional, Tuple, List, Dict, Any, Union, Generator
 
 from bs4 import BeautifulSoup
+from google_auth_httplib2 import AuthorizedHttp
+from google.auth.credentials import Credentials
 from googleapiclient.errors import HttpError
 
 from amocrm import Amo
 from classification_model import SGDClassificator
-from google_api_utils import get_service, Resource, get_labels, USER_ID
+from google_api_utils import (
+    get_service, get_thread_http, get_credentials, refresh_credentials, Resource, get_labels, USER_ID, NUM_RETRIES
+)
+from model_feedback import ModelFeedback
 
 log = logging.getLogger("Mail sorter")
 logging.basicConfig(level='INFO')
@@ -33,7 +41,8 @@ def main():
     parser.add_argument(
         '-j',
         '--jobs',
-        help="Количество воркеров для одновременной обработки писем.",
+        help="Количество воркеров для одновременной обработки писем. "
+             "В режиме hybrid ограничивает пул процессов для разбора писем.",
         type=int,
         default=4,
     )
@@ -51,27 +60,69 @@ def main():
         type=str,
         default='***@***.ru',
     )
+    parser.add_argument(
+        '-f',
+        '--feedback-interval',
+        help="Кол-во секунд между проверками писем перенесенных вручную между метками классификатора "
+             "для дообучения модели. 0 - не дообучать.",
+        type=int,
+        default=300,
+    )
+    parser.add_argument(
+        '-e',
+        '--executor',
+        help="Режим обработки писем. process: каждое письмо целиком обрабатывается в пуле процессов (-j процессов). "
+             "hybrid: запросы к Gmail в пуле тредов (-w тредов), разбор и классификация в пуле процессов по числу CPU.",
+        choices=['process', 'hybrid'],
+        default='process',
+    )
+    parser.add_argument(
+        '-w',
+        '--io-threads',
+        help="Количество тредов для запросов к Gmail в режиме hybrid.",
+        type=int,
+        default=32,
+    )
     jobs: int = parser.parse_args().jobs
     timeout: int = parser.parse_args().timeout
     responsible_user: str = parser.parse_args().responsible_user
+    feedback_interval: int = parser.parse_args().feedback_interval
+    executor: str = parser.parse_args().executor
+    io_threads: int = parser.parse_args().io_threads
     amo = Amo('***@***.ru', responsible_user)
+    credentials: Credentials = get_credentials()
+
+    # Дообучение идет в фоновом треде главного процесса. Пул воркеров создается заново на каждой итерации,
+    # поэтому форкнутые воркеры получают последнюю версию модели без остановки обработки почты.
+    feedback: Optional[ModelFeedback] = None
+    if feedback_interval > 0:
+        feedback = ModelFeedback(clf, credentials, labels, get_msg_text, feedback_interval)
+        feedback.start()
+
+    # Пул тредов живет все время работы, чтобы треды не пересоздавали свои http транспорты на каждой итерации.
+    # Клиент Gmail API у тредов общий, транспорт у каждого свой (см. get_thread_http).
+    io_pool: Optional[ThreadPool] = None
+    io_service: Optional[Resource] = None
+    if executor == 'hybrid':
+        io_service = get_service(credentials)
+        io_pool = ThreadPool(processes=io_threads, initializer=get_thread_http, initargs=(credentials,))
 
     while True:
         messages: List[Tuple[Any, Resource]] = get_messages()
         log.info(f"Найдено {len(messages)} новых сообщений")
         msgs: List[Dict[str, Any]] = list()
         try:
-            if 0 < len(messages) < jobs:
-                current_jobs: int = len(messages)
+            if io_pool:
+                refresh_credentials(credentials)
+                results: List[Tuple[Dict[str, Any], bool]] = process_hybrid(messages, io_pool, io_service, jobs)
             else:
-                current_jobs = jobs
+                results = process_in_pool(messages, jobs)
 
-            with Pool(processes=current_jobs) as pool:
-                msg: Dict[str, Any]
-                lead: bool
-                for msg, lead in pool.map(task, messages):
-                    if lead:
-                        msgs.append(msg)
+            msg: Dict[str, Any]
+            lead: bool
+            for msg, lead in results:
+                if lead:
+                    msgs.append(msg)
 
             log.info(f'Входящая почта обработана. Найдено {len(msgs)} заявок.')
 
@@ -86,9 +137,149 @@ def main():
             time.sleep(timeout)
         except KeyboardInterrupt:
             log.info('Цикл обработки прерван пользователем.')
+            if feedback:
+                feedback.stop()
+            if io_pool:
+                io_pool.terminate()
             return
 
 
+def process_in_pool(messages: List[Tuple[Any, Resource]], jobs: int) -> List[Tuple[Dict[str, Any], bool]]:
+    """Обрабатывает письма целиком, вместе с запросами к Gmail, в пуле процессов."""
+    if 0 < len(messages) < jobs:
+        jobs = len(messages)
+
+    with Pool(processes=jobs) as pool:
+        return pool.map(task, messages)
+
+
+def process_hybrid(
+        messages: List[Tuple[Any, Resource]],
+        io_pool: ThreadPool,
+        io_service: Resource,
+        jobs: int,
+) -> List[Tuple[Dict[str, Any], bool]]:
+    """
+    Запросы к Gmail (письмо, вложения, смена меток) выполняются в пуле тредов, где они просто ждут сеть.
+    Разбор и классификация идут в пуле процессов по числу доступных CPU, но не больше jobs.
+    В процессы уходит только само письмо, вложения остаются в главном процессе и к классификации не относятся.
+    imap забирает скачанные письма по мере готовности, так что разбор идет параллельно со скачиванием.
+    Пул процессов создается на каждой итерации, чтобы воркеры получали актуальную версию дообучаемой модели.
+    Письма которые не удалось скачать, разобрать или пометить пропускаются и остаются непрочитанными,
+    так что попадут в обработку на следующей итерации, а не уронят всю пачку.
+    """
+    if not messages:
+        return list()
+
+    message_ids: List[str] = [message_id for message_id, _ in messages]
+    # (id письма, вложения) в том же порядке, в котором письма отданы в пул процессов
+    fetched: List[Tuple[str, List[Dict[str, Union[str, bytes]]]]] = list()
+
+    def fetched_messages() -> Generator[Dict[str, Any], None, None]:
+        fetch_result: Optional[Tuple[Dict[str, Any], List[Dict[str, Union[str, bytes]]]]]
+        for fetch_result in io_pool.imap(partial(fetch_msg, service=io_service), message_ids):
+            if fetch_result:
+                fetched.append((fetch_result[0]['id'], fetch_result[1]))
+                yield fetch_result[0]
+
+    marked: List[Tuple[Dict[str, Any], bool, AsyncResult]] = list()
+    with Pool(processes=max(1, min(len(message_ids), jobs, get_cpu_count()))) as cpu_pool:
+        i: int
+        parsed: Optional[Tuple[Dict[str, Any], bool]]
+        for i, parsed in enumerate(cpu_pool.imap(try_parse_msg, fetched_messages())):
+            if not parsed:
+                continue
+            message_id: str
+            attachments: List[Dict[str, Union[str, bytes]]]
+            message_id, attachments = fetched[i]
+            msg: Dict[str, Any]
+            lead: bool
+            msg, lead = parsed
+            msg['attachments'] = attachments
+            mark: AsyncResult = io_pool.apply_async(
+                mark_msg_in_thread, (message_id, lead, io_service), error_callback=log_mark_error
+            )
+            marked.append((msg, lead, mark))
+
+    # Ждем смены меток, иначе на следующей итерации еще не помеченные письма попадут в выборку непрочитанных повторно.
+    # Непомеченное письмо в АМО не отдаем: оно осталось непрочитанным и на следующей итерации дало бы дубль заявки.
+    results: List[Tuple[Dict[str, Any], bool]] = list()
+    for msg, lead, mark in marked:
+        mark.wait()
+        if mark.successful():
+            results.append((msg, lead))
+    return results
+
+
+def get_cpu_count() -> int:
+    """
+    Возвращает кол-во CPU доступных процессу. В LXC контейнере os.cpu_count() часто отдает кол-во CPU хоста,
+    а sched_getaffinity учитывает ограничение cpuset.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def fetch_msg(
+        message_id: str,
+        service: Resource,
+) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Union[str, bytes]]]]]:
+    """
+    Выполняется в треде. Скачивает письмо и его вложения. Вложения раскодируются здесь же,
+    чтобы не гонять их в пул процессов и обратно.
+    Если письмо скачать не удалось, возвращает None: письмо пропускается и остается непрочитанным.
+    """
+    http: AuthorizedHttp = get_thread_http()
+    try:
+        message: Dict[str, Any] = service.users().messages().get(userId=USER_ID, id=message_id) \
+            .execute(http=http, num_retries=NUM_RETRIES)
+        return message, get_attachments((message.get('payload') or {}).get('parts'), message_id, service, http)
+    except HttpError:
+        log.exception(f'Не удалось скачать письмо {message_id}, оно будет обработано на следующей итерации.')
+        return None
+
+
+def parse_msg(message: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """Разбирает скачанное письмо и решает заявка ли это. Вложения в письмо добавляет вызывающий код."""
+    msg: Dict[str, Any] = get_msg(message)
+
+    if clf.get_prediction(get_classifier_text(msg)) == 0:
+        log.info('Заявка не обнаружена')
+        return msg, False
+    log.info('Обнаружена заявка')
+    return msg, True
+
+
+def try_parse_msg(message: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], bool]]:
+    """Выполняется в процессе. Ошибка разбора одного письма не должна ронять всю пачку: такое письмо пропускается."""
+    try:
+        return parse_msg(message)
+    except Exception:
+        log.exception(f"Не удалось разобрать письмо {message.get('id')}, оно останется непрочитанным.")
+        return None
+
+
+def mark_msg(message_id: str, lead: bool, service: Resource, http: Optional[AuthorizedHttp] = None):
+    """Метит письмо как прочитанное и ставит метку классификатора."""
+    label_body: Dict[str, List[str]] = {
+        'removeLabelIds': [labels['UNREAD']],
+        'addLabelIds': [labels['Заявка'] if lead else labels['Не заявка']],
+    }
+    service.users().messages().modify(userId=USER_ID, id=message_id, body=label_body) \
+        .execute(http=http, num_retries=NUM_RETRIES)
+    log.debug(f'Письмо {message_id} помечено как прочитанное на сервере.')
+
+
+def mark_msg_in_thread(message_id: str, lead: bool, service: Resource):
+    """Выполняется в треде. mark_msg через http транспорт текущего треда."""
+    mark_msg(message_id, lead, service, get_thread_http())
+
+
+def log_mark_error(e: BaseException):
+    log.error(f'Не удалось пометить письмо как прочитанное: {e!r}')
+
+
 def get_messages():
     """Запрашивает список непрочитанных писем в ящике."""
     page_token: Optional[str] = None
@@ -120,29 +311,16 @@ def task(args) -> Tuple[Dict[str, Any], bool]:
     Обработка 50 непрочитанных сообщений в gmail ящике в параллели занимает 14 секунд против 50-и сек. в простом цикле.
     """
     try:
-        message: Dict[str, Any]
+        message_id: str
         service: Resource
-        message, service = args
-        msg: Dict[str, Any] = service.users().messages().get(userId=USER_ID, id=message).execute()
-        msg = get_msg(msg, service)
-
-        label_body: Dict[str, List[str]] = {
-            'removeLabelIds': [labels['UNREAD']],
-        }
-
-        msg_text_content: str = msg['subject'] + msg['body'] + html2text(msg['html'])
-
-        if clf.get_prediction(msg_text_content) == 0:
-            log.info('Заявка не обнаружена')
-            label_body['addLabelIds'] = [labels['Не заявка']]
-            lead = False
-        else:
-            log.info('Обнаружена заявка')
-            label_body['addLabelIds'] = [labels['Заявка']]
-            lead = True
-
-        service.users().messages().modify(userId=USER_ID, id=message, body=label_body).execute()
-        log.debug(f'Письмо {message} помечено как прочитанное на сервере.')
+        message_id, service = args
+        message: Dict[str, Any] = service.users().messages().get(userId=USER_ID, id=message_id) \
+            .execute(num_retries=NUM_RETRIES)
+        msg: Dict[str, Any]
+        lead: bool
+        msg, lead = parse_msg(message)
+        msg['attachments'] = get_attachments((message.get('payload') or {}).get('parts'), message_id, service)
+        mark_msg(message_id, lead, service)
         return msg, lead
 
     except KeyboardInterrupt:
@@ -164,6 +342,24 @@ def html2text(html: str) -> str:
     return '\n'.join(chunk for chunk in chunks if chunk)
 
 
+def get_classifier_text(msg: Dict[str, Any]) -> str:
+    """Возвращает текст подготовленного письма (см. get_msg), по которому классификатор решает заявка ли это."""
+    return msg['subject'] + msg['body'] + html2text(msg['html'])
+
+
+def get_msg_text(message: Dict[str, Any]) -> str:
+    """
+    Возвращает текст письма из Gmail в том виде, в котором его получает классификатор (см. parse_msg).
+    В отличие от get_msg не скачивает вложения.
+    """
+    payload: Dict[str, Any] = message.get('payload') or {}
+    return get_classifier_text({
+        'subject': get_subject(payload),
+        'body': get_body(message, 'text/plain'),
+        'html': get_body(message, 'text/html'),
+    })
+
+
 def get_sender(from_header: str) -> Tuple[str, str]:
     """Возвращает имя и адрес получателя из заголовка From. Имени может и не быть"""
     sender_name: str
@@ -183,8 +379,8 @@ def get_sender(from_header: str) -> Tuple[str, str]:
     return sender_name, sender_address
 
 
-def get_msg(message: Dict[str, Any], service: Resource):
-    """Подготавливает письмо для экспорта в Amo CRM."""
+def get_msg(message: Dict[str, Any]):
+    """Подготавливает письмо для экспорта в Amo CRM. Вложения скачиваются отдельно (см. get_attachments)."""
     payload: Dict[str, Any] = message.get('payload')
 
     sender_name: str
@@ -199,7 +395,7 @@ def get_msg(message: Dict[str, Any], service: Resource):
         'subject': subject,
         'body': text_body,
         'html': html_body,
-        'attachments': get_attachments(payload.get('parts'), message['id'], service),
+        'attachments': list(),
         'contact': {
             'name': sender_name,
             'post': None,
@@ -309,12 +505,13 @@ def get_attachments(
         parts: List[Dict[str, Any]],
         message_id: str,
         service: Resource,
-        attachments: List[Dict[str, Union[str, bytes]]] = list()
-) -> List[Optional[Dict[str, Union[str, bytes]]]]:
+        http: Optional[AuthorizedHttp] = None,
+) -> List[Dict[str, Union[str, bytes]]]:
     """Возвращает коллекцию файлов-вложений письма для последущего экспорта в Amo CRM"""
     part: Dict[str, Any]
+    attachments: List[Dict[str, Union[str, bytes]]] = list()
     if not parts:
-        return list()
+        return attachments
 
     for part in parts:
         header: str = get_header(part.get('headers'), 'Content-Disposition')
@@ -324,25 +521,22 @@ def get_attachments(
             continue
 
         attachment_id: str = part['body']['attachmentId']
-        filename: str = part['filename']
-
         attachment: Dict[str, Any] = service.users().messages().attachments() \
-            .get(userId=USER_ID, messageId=message_id, id=attachment_id).execute()
+            .get(userId=USER_ID, messageId=message_id, id=attachment_id).execute(http=http, num_retries=NUM_RETRIES)
 
         try:
-            attachment: bytes = urlsafe_b64decode(attachment['data'])
+            attachments.append({
+                'name': part['filename'],
+                'data': urlsafe_b64decode(attachment['data']),
+                'mime': part['mimeType'],
+                'size': part['body']['size'],
+            })
         except BinasciiError:
             log.exception("Не удалось декодировать base64 attachment'а.")
 
-        attachments.append({
-            'name': filename,
-            'data': attachment,
-            'mime': part['mimeType'],
-            'size': part['body']['size'],
-        })
         if 'parts' in part:
             log.info('При разборе вложений обнаружен вложенный parts.')
-            attachments += get_attachments(part['parts'], message_id, attachments)
+            attachments += get_attachments(part['parts'], message_id, service, http)
 
     return attachments
 
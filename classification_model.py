@@ -1,7 +1,14 @@
+import copy
+import logging
+import os
 import pickle
+import re
+import threading
 
 from abc import ABC, abstractmethod
 
+log = logging.getLogger("Classification model")
+
 
 class ClassificationModel(ABC):
     @abstractmethod
@@ -15,20 +22,70 @@ class RandomProbability(ClassificationModel):
 
 
 class SGDClassificator(ClassificationModel):
+    MODEL_FILE = 'sgdc_model.pickle'
+    SNAPSHOTS_DIR = 'models'
+    SNAPSHOT_NAME = re.compile(r'^sgdc_model\.v(\d+)\.pickle$')
+    KEEP_SNAPSHOTS = 5
+
     def __init__(self):
-        self.model = self.load_model()
+        self._update_lock = threading.Lock()
+        self.version, self.model = self.load_model()
         self.transformer = self.load_transformer()
 
-    @staticmethod
-    def load_model():
-        with open('sgdc_model.pickle', 'rb') as f:
-            return pickle.load(f)
+    @classmethod
+    def _get_snapshots(cls):
+        """Возвращает {версия: путь} дообученных снапшотов модели."""
+        if not os.path.isdir(cls.SNAPSHOTS_DIR):
+            return {}
+
+        snapshots = {}
+        for name in os.listdir(cls.SNAPSHOTS_DIR):
+            match = cls.SNAPSHOT_NAME.match(name)
+            if match:
+                snapshots[int(match.group(1))] = os.path.join(cls.SNAPSHOTS_DIR, name)
+        return snapshots
+
+    @classmethod
+    def load_model(cls):
+        """
+        Загружает последний дообученный снапшот модели, а если его нет - исходную модель.
+        Битый снапшот (например недописанный при потере питания) пропускается в пользу предыдущего.
+        Возвращает версию модели (0 для исходной) и саму модель.
+        """
+        snapshots = cls._get_snapshots()
+        for version in sorted(snapshots, reverse=True):
+            try:
+                with open(snapshots[version], 'rb') as f:
+                    return version, pickle.load(f)
+            except Exception:
+                log.exception(f'Не удалось загрузить снапшот модели {snapshots[version]}, пробуем предыдущий.')
+
+        with open(cls.MODEL_FILE, 'rb') as f:
+            return 0, pickle.load(f)
 
     @staticmethod
     def load_transformer():
         with open('tfidf.pickle', 'rb') as f:
             return pickle.load(f)
 
+    def _save_snapshot(self, model, version):
+        """
+        Пишет снапшот во временный файл и переименовывает его, чтобы на диске не было недописанных версий.
+        Хранит только KEEP_SNAPSHOTS последних версий.
+        """
+        os.makedirs(self.SNAPSHOTS_DIR, exist_ok=True)
+        path = os.path.join(self.SNAPSHOTS_DIR, f'sgdc_model.v{version}.pickle')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(model, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        snapshots = self._get_snapshots()
+        for old_version in sorted(snapshots)[:-self.KEEP_SNAPSHOTS]:
+            os.remove(snapshots[old_version])
+
     def transform_message(self, message_text):
         return self.transformer.transform([message_text])
 
@@ -36,7 +93,28 @@ class SGDClassificator(ClassificationModel):
         transformed_text = self.transform_message(message_text)
         return self.model.predict(transformed_text)[0]
 
+    def partial_fit(self, messages_texts, targets, batch_size=16):
+        """
+        Дообучает модель на исправленных вручную письмах мини-батчами по batch_size.
+        Обучается копия модели: текущая продолжает классифицировать письма, пока копия не сохранена
+        новой версией на диск, после чего подменяется одним присваиванием.
+        Возвращает номер новой версии модели.
+        """
+        with self._update_lock:
+            model = copy.deepcopy(self.model)
+            for i in range(0, len(messages_texts), batch_size):
+                model.partial_fit(
+                    self.transformer.transform(messages_texts[i:i + batch_size]),
+                    targets[i:i + batch_size],
+                    classes=model.classes_,
+                )
+
+            version = self.version + 1
+            self._save_snapshot(model, version)
+            self.model = model
+            self.version = version
+            return version
+
 
 if __name__ == '__main__':
     clf = SGDClassificator()
-
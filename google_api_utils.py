@@ -1,9 +1,12 @@
 import os
 import pickle
+import threading
 from typing import Optional, Dict, Any
 
+import httplib2
 from google.auth.credentials import Credentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build, Resource
 
@@ -11,12 +14,16 @@ from googleapiclient.discovery import build, Resource
 # https://developers.google.com/gmail/api/auth/scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 USER_ID = '***@***.ru'
+# Сколько раз execute повторяет запрос при 429/5xx от Gmail (с экспоненциальной паузой)
+NUM_RETRIES = 5
 
 flow = InstalledAppFlow.from_client_secrets_file(
     'credentials.json', SCOPES)
 
+_thread_local = threading.local()
 
-def get_service() -> Resource:
+
+def get_credentials() -> Credentials:
     creds: Optional[Credentials] = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first time.
@@ -36,7 +43,31 @@ def get_service() -> Resource:
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
 
-    return build('gmail', 'v1', credentials=creds, cache_discovery=False)
+    return creds
+
+
+def get_service(credentials: Optional[Credentials] = None) -> Resource:
+    return build('gmail', 'v1', credentials=credentials or get_credentials(), cache_discovery=False)
+
+
+def get_thread_http(credentials: Optional[Credentials] = None) -> AuthorizedHttp:
+    """
+    Возвращает http транспорт текущего треда для передачи в execute(http=...).
+    httplib2.Http не потокобезопасен, поэтому у каждого треда свой, а клиент Gmail API (Resource) общий:
+    build на каждый тред заново скачивал бы discovery документ и держал в памяти его копию.
+    """
+    if not hasattr(_thread_local, 'http'):
+        _thread_local.http = AuthorizedHttp(credentials, http=httplib2.Http())
+    return _thread_local.http
+
+
+def refresh_credentials(credentials: Credentials):
+    """
+    Обновляет протухший токен заранее в одном треде,
+    чтобы треды с общими реквизитами не обновляли его одновременно.
+    """
+    if not credentials.valid:
+        credentials.refresh(Request())
 
 
 def get_labels(service):
@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+from typing import Optional, List, Dict, Any, Callable, Set
+
+from google.auth.credentials import Credentials
+from googleapiclient.errors import HttpError
+
+from classification_model import SGDClassificator
+from google_api_utils import get_service, Resource, USER_ID
+
+log = logging.getLogger("Model feedback")
+logging.basicConfig(level='INFO')
+
+HISTORY_ID_FILE: str = 'feedback_history_id'
+
+# Метки которыми классификатор размечает письма и соответствующие им классы модели (см. app.parse_msg)
+LABEL_TARGETS: Dict[str, int] = {
+    'Не заявка': 0,
+    'Заявка': 1,
+}
+
+
+class ModelFeedback(threading.Thread):
+    """
+    Фоновая стадия дообучения модели на исправлениях менеджеров.
+    Сам классификатор метки `Заявка` / `Не заявка` только добавляет, поэтому снятие одной из них со
+    письма в истории ящика означает, что письмо перенесли вручную. Такие письма находятся через Gmail
+    history API без перебора всего ящика и скармливаются модели через partial_fit.
+    """
+
+    def __init__(
+            self,
+            clf: SGDClassificator,
+            credentials: Credentials,
+            labels: Dict[str, str],
+            get_msg_text: Callable[[Dict[str, Any]], str],
+            interval: int,
+            batch_size: int = 16,
+    ):
+        super().__init__(name='model-feedback', daemon=True)
+        self._clf: SGDClassificator = clf
+        # Реквизиты загружает главный тред, иначе при невалидном токене фоновый тред сам запустит
+        # авторизацию через браузер и будет перезаписывать token.pickle параллельно с главным
+        self._credentials: Credentials = credentials
+        self._get_msg_text: Callable[[Dict[str, Any]], str] = get_msg_text
+        self._interval: int = interval
+        self._batch_size: int = batch_size
+        self._targets: Dict[str, int] = {labels[name]: target for name, target in LABEL_TARGETS.items()}
+        self._stop_event: threading.Event = threading.Event()
+        # httplib2 не потокобезопасен, поэтому у фонового треда свой клиент Gmail API
+        self._service: Optional[Resource] = None
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while True:
+            try:
+                # Клиент и стартовый historyId создаются в цикле, чтобы сбой сети при старте не убил тред
+                if not self._service:
+                    self._service = get_service(self._credentials)
+                if not os.path.exists(HISTORY_ID_FILE):
+                    self._save_history_id(self._get_current_history_id())
+                else:
+                    self.process_corrections()
+            except Exception:
+                log.exception('Ошибка при дообучении модели на исправленных письмах.')
+
+            if self._stop_event.wait(self._interval):
+                return
+
+    def process_corrections(self):
+        """Находит перенесенные между метками письма с прошлого запуска и дообучает на них модель."""
+        history_id: str = self._load_history_id()
+        message_ids: Set[str]
+        message_ids, last_history_id = self._get_relabeled_ids(history_id)
+
+        texts: List[str] = list()
+        targets: List[int] = list()
+        message_id: str
+        for message_id in message_ids:
+            try:
+                message: Dict[str, Any] = self._service.users().messages() \
+                    .get(userId=USER_ID, id=message_id).execute()
+            except HttpError as e:
+                # Письмо удалено. На остальные ошибки historyId не сохраняем, чтобы повторить в следующий раз
+                if e.resp.status != 404:
+                    raise
+                log.warning(f'Исправленное письмо {message_id} не найдено, возможно оно удалено.')
+                continue
+
+            current_targets: Set[int] = {
+                self._targets[label_id] for label_id in message.get('labelIds', []) if label_id in self._targets
+            }
+            # Письмо без меток или сразу с обеими - не понятно чему учить модель
+            if len(current_targets) != 1:
+                continue
+            texts.append(self._get_msg_text(message))
+            targets.append(current_targets.pop())
+
+        if texts:
+            version: int = self._clf.partial_fit(texts, targets, self._batch_size)
+            log.info(f'Модель дообучена на {len(texts)} исправленных письмах, версия модели: {version}.')
+
+        self._save_history_id(last_history_id)
+
+    def _get_relabeled_ids(self, start_history_id: str):
+        """Возвращает id писем с которых снимали метки классификатора и последний historyId ящика."""
+        page_token: Optional[str] = None
+        message_ids: Set[str] = set()
+        last_history_id: str = start_history_id
+        try:
+            while True:
+                response: Dict[str, Any] = self._service.users().history().list(
+                    userId=USER_ID,
+                    startHistoryId=start_history_id,
+                    historyTypes=['labelRemoved'],
+                    pageToken=page_token,
+                ).execute()
+
+                for record in response.get('history', []):
+                    for change in record.get('labelsRemoved', []):
+                        if any(label_id in self._targets for label_id in change.get('labelIds', [])):
+                            message_ids.add(change['message']['id'])
+
+                last_history_id = response.get('historyId', last_history_id)
+                if 'nextPageToken' in response:
+                    page_token = response['nextPageToken']
+                else:
+                    break
+
+        except HttpError as e:
+            # Gmail хранит историю ограниченное время, на слишком старый startHistoryId отвечает 404
+            if e.resp.status != 404:
+                raise
+            log.warning('История изменений ящика устарела, исправления с прошлого запуска пропущены.')
+            return set(), self._get_current_history_id()
+
+        return message_ids, last_history_id
+
+    def _get_current_history_id(self) -> str:
+        return self._service.users().getProfile(userId=USER_ID).execute()['historyId']
+
+    @staticmethod
+    def _load_history_id() -> str:
+        with open(HISTORY_ID_FILE) as f:
+            return f.read().strip()
+
+    @staticmethod
+    def _save_history_id(history_id: str):
+        tmp_path: str = f'{HISTORY_ID_FILE}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(history_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, HISTORY_ID_FILE)